@@ -16,7 +16,7 @@ http://faemiyah.fi/demoscene/vgl
 """
 
 import bpy
-import copy
+import numpy as np
 import os
 import re
 from mathutils import Vector
@@ -53,27 +53,42 @@ def vgl_log(op):
 # Templates ############################
 ########################################
 
+g_regex_template_key = re.compile(r'\[\[\s*([^\]]+?)\s*\]\]')
+
 class Template:
     """Class for templated string generation."""
 
     def __init__(self, content):
         """Constructor."""
         self.__content = content
+        # Split into literals and substitution keys only once, every odd element is a key.
+        self.__segments = g_regex_template_key.split(content)
+        self.__keys = self.__segments[1::2]
+        self.__key_set = frozenset(self.__keys)
+
+    def substitute(self, substitutions=None):
+        """Return formatted output as a list of segments."""
+        if not substitutions:
+            substitutions = {}
+        for kk in substitutions:
+            if not kk in self.__key_set:
+                print("WARNING: substitution '%s' has no matches" % (kk))
+        if is_verbose():
+            unmatched = [kk for kk in self.__keys if not kk in substitutions]
+            if unmatched:
+                print("Template substitutions not matched: %s (%i)" % (str(list(set(unmatched))), len(unmatched)))
+        ret = list(self.__segments)
+        ret[1::2] = [substitutions.get(kk, "") for kk in self.__keys]
+        return ret
 
     def format(self, substitutions=None):
         """Return formatted output."""
-        ret = self.__content
-        if substitutions:
-            for kk in substitutions:
-                vv = substitutions[kk].replace("\\", "\\\\")
-                (ret, num) = re.subn(r'\[\[\s*%s\s*\]\]' % (kk), vv, ret)
-                if not num:
-                    print("WARNING: substitution '%s' has no matches" % (kk))
-        unmatched = list(set(re.findall(r'\[\[([^\]]+)\]\]', ret)))
-        (ret, num) = re.subn(r'\[\[[^\]]+\]\]', "", ret)
-        if num and is_verbose():
-            print("Template substitutions not matched: %s (%i)" % (str(unmatched), num))
-        return ret
+        return "".join(self.substitute(substitutions))
+
+    def write(self, fd, substitutions=None):
+        """Write formatted output into a binary file segment by segment."""
+        for ii in self.substitute(substitutions):
+            fd.write(ii.encode("utf-8"))
 
     def __str__(self):
         """String representation."""
@@ -84,7 +99,7 @@ g_template_header = Template("""#ifndef [[HEADER_NAME]]
 [[MODEL_DATA]]\n
 #endif""")
 
-g_template_mesh = Template("""int16_t g_[[MODEL_NAME]]_vertices[] =
+g_template_mesh = Template("""[[VERTEX_TYPE]] g_[[MODEL_NAME]]_vertices[] =
 {
 [[VERTEX_DATA]]
 };\n
@@ -93,6 +108,15 @@ g_template_mesh = Template("""int16_t g_[[MODEL_NAME]]_vertices[] =
 [[INDEX_DATA]]
 };""")
 
+g_template_vertex_quantization = Template("""float g_[[MODEL_NAME]]_vertex_offset[] =
+{
+[[OFFSET_DATA]]
+};\n
+float g_[[MODEL_NAME]]_vertex_step[] =
+{
+[[STEP_DATA]]
+};""")
+
 g_template_weights = Template("""uint8_t g_weights_[[MODEL_NAME]][] =
 {
 [[WEIGHT_DATA]]
@@ -112,12 +136,21 @@ g_template_anim = Template("""int16_t g_animation_[[MODEL_NAME]]_[[ANIM_NAME]][]
 [[ANIM_DATA]]
 };""")
 
+g_template_anim_packed = Template("""int16_t g_animation_packed_[[MODEL_NAME]]_[[ANIM_NAME]][] =
+{
+[[ANIM_DATA]]
+};""")
+
 g_indent = "  "
 
+g_write_buffer_size = 128 * 1024
+
 ########################################
 # Pose #################################
 ########################################
 
+g_regex_pose_name = re.compile(r'\s*(\S+)\s+([\d\.]+)\s*$')
+
 class Pose:
     """Abstraction of pose."""
 
@@ -125,10 +158,10 @@ class Pose:
         """Constructor."""
         self.__pose = pose
         self.__index = index
-        match = re.match(r'\s*(\S+)\s+([\d\.]+)\s*$', pose.name.strip())
+        match = g_regex_pose_name.match(pose.name.strip())
         if match:
-            self.__basename = match.groups(1)[0]
-            self.__time = float(match.groups(1)[1])
+            self.__basename = match.group(1)
+            self.__time = float(match.group(2))
         else:
             self.__basename = pose.name
             self.__time = 0.0
@@ -146,24 +179,22 @@ class Pose:
         """Accessor."""
         return self.__time
 
-    def __lt__(self, other):
-        """Less than function."""
-        return self.__time < other.getTime()
-
 ########################################
 # Export ###############################
 ########################################
 
+g_regex_export_name = re.compile(r'g_([^\.]+)(\.\d+)?')
+
 def isExportName(name):
     """Tell if named object wants to be exported."""
     return name.startswith("g_")
 
 def toExportName(name):
     """Convert name to .cpp -friendly name."""
-    match = re.match(r'g_([^\.]+)(\.\d+)?', name)
+    match = g_regex_export_name.match(name)
     if not match:
         raise RuntimeError("name '%s' is not C++ -friendly" % (name))
-    return match.groups(1)[0]
+    return match.group(1)
 
 def toExport8F8(op):
     """Converts number to exportable 8.8 signed fixed point number."""
@@ -181,148 +212,336 @@ def toExportU8(op):
     """Converts number to exportable unsigned 8-bit number."""
     return max(min(int(round(op)), 255), 0)
 
+def toExportString(data, suffixes=None):
+    """Converts rows of an integer array to C++ array lines, formatting everything at once."""
+    line = g_indent + ", ".join(["%i"] * data.shape[1]) + ","
+    if suffixes:
+        fmt = "\n".join([line + ii for ii in suffixes])
+    else:
+        fmt = "\n".join([line] * len(data))
+    return fmt % tuple(data.ravel().tolist())
+
+def toExportPackedQuaternions(quaternions):
+    """Packs (w, x, y, z) quaternions into 10-10-10-2 format, returned as two signed 16-bit halves each."""
+    # Largest component is dropped and its index stored in the 2-bit field, it is reconstructed from unit length.
+    largest = np.argmax(np.abs(quaternions), axis=1)
+    # Quaternion and its negation are the same rotation, make the dropped component positive.
+    signs = np.where(0.0 > quaternions[np.arange(len(quaternions)), largest], -1.0, 1.0)
+    remaining = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])[largest]
+    # Remaining components are within [-1/sqrt(2), 1/sqrt(2)], scale them to full 10-bit range.
+    abc = np.take_along_axis(quaternions, remaining, axis=1) * (signs * np.sqrt(2.0))[:, np.newaxis]
+    abc = np.clip(np.rint(abc * 511.0), -511, 511).astype(np.int64) & 0x3ff
+    packed = abc[:, 0] | (abc[:, 1] << 10) | (abc[:, 2] << 20) | (largest.astype(np.int64) << 30)
+    halves = np.stack((packed & 0xffff, packed >> 16), axis=1)
+    return np.where(halves >= 32768, halves - 65536, halves)
+
 def findRootBone(bone):
     """Find bone root."""
-    if not bone.parent:
-        return bone
-    return findRootBone(bone.parent)
-
-def toExportBoneQuaternion(bone_orig, bone_curr):
-    """Create exportable bone oritentation by undoing Blender's bone transform mangling."""
-    world = bone_orig.matrix_local.inverted()
-    qq = (bone_curr.matrix @ world).to_quaternion()
-    return qq
-
-def toExportBonePosition(mat, bone_quaternion, bone_orig, bone_curr):
-    """Create exportable bone position by creating a difference transform from neutral state."""
-    pos_orig = mat @ bone_orig.head_local
-    pos_curr = mat @ bone_curr.head
+    while bone.parent:
+        bone = bone.parent
+    return bone
+
+def getBoneMatrices(bones, attr):
+    """Reads given matrix attribute of all bones into an array of row-major matrices."""
+    # Buffer type must match the float property for foreach_get to copy it as raw memory.
+    ret = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get(attr, ret)
+    # Blender hands out matrices in column-major order.
+    return ret.astype(np.float64).reshape(-1, 4, 4).transpose(0, 2, 1)
+
+def getBoneVectors(bones, attr):
+    """Reads given vector attribute of all bones into an array."""
+    ret = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get(attr, ret)
+    return ret.astype(np.float64).reshape(-1, 3)
+
+def matricesToQuaternions(mats):
+    """Converts rotation part of matrices to quaternions, branching the same way as Matrix.to_quaternion()."""
+    mm = mats[:, :3, :3]
+    mm = mm / np.linalg.norm(mm, axis=1, keepdims=True)
+    (m00, m01, m02) = (mm[:, 0, 0], mm[:, 0, 1], mm[:, 0, 2])
+    (m10, m11, m12) = (mm[:, 1, 0], mm[:, 1, 1], mm[:, 1, 2])
+    (m20, m21, m22) = (mm[:, 2, 0], mm[:, 2, 1], mm[:, 2, 2])
+    ret = np.empty((len(mm), 4), dtype=np.float64)
+    tr = 0.25 * (1.0 + m00 + m11 + m22)
+    sel_w = tr > 1e-4
+    sel_x = ~sel_w & (m00 > m11) & (m00 > m22)
+    sel_y = ~sel_w & ~sel_x & (m11 > m22)
+    sel_z = ~sel_w & ~sel_x & ~sel_y
+    # Errors from square roots of negative numbers are discarded by the selection.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sw = np.sqrt(tr)
+        sx = 2.0 * np.sqrt(1.0 + m00 - m11 - m22)
+        sy = 2.0 * np.sqrt(1.0 + m11 - m00 - m22)
+        sz = 2.0 * np.sqrt(1.0 + m22 - m00 - m11)
+        ret[sel_w] = np.stack((sw, (m21 - m12) / (4.0 * sw), (m02 - m20) / (4.0 * sw), (m10 - m01) / (4.0 * sw)), axis=1)[sel_w]
+        ret[sel_x] = np.stack(((m21 - m12) / sx, 0.25 * sx, (m01 + m10) / sx, (m02 + m20) / sx), axis=1)[sel_x]
+        ret[sel_y] = np.stack(((m02 - m20) / sy, (m01 + m10) / sy, 0.25 * sy, (m12 + m21) / sy), axis=1)[sel_y]
+        ret[sel_z] = np.stack(((m10 - m01) / sz, (m02 + m20) / sz, (m12 + m21) / sz, 0.25 * sz), axis=1)[sel_z]
+    return ret / np.linalg.norm(ret, axis=1, keepdims=True)
+
+def quaternionsToMatrices(quaternions):
+    """Converts quaternions to 3x3 rotation matrices."""
+    (qw, qx, qy, qz) = (quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3])
+    return np.stack((
+        np.stack((1.0 - 2.0 * (qy * qy + qz * qz), 2.0 * (qx * qy - qz * qw), 2.0 * (qx * qz + qy * qw)), axis=1),
+        np.stack((2.0 * (qx * qy + qz * qw), 1.0 - 2.0 * (qx * qx + qz * qz), 2.0 * (qy * qz - qx * qw)), axis=1),
+        np.stack((2.0 * (qx * qz - qy * qw), 2.0 * (qy * qz + qx * qw), 1.0 - 2.0 * (qx * qx + qy * qy)), axis=1),
+        ), axis=1)
+
+def transformPositions(mat, positions):
+    """Transforms an array of positions with a 4x4 matrix."""
+    mm = np.array(mat)
+    return positions @ mm[:3, :3].T + mm[:3, 3]
+
+def toExportBoneQuaternions(world, bones_curr):
+    """Create exportable bone oritentations by undoing Blender's bone transform mangling."""
+    return matricesToQuaternions(bones_curr @ world)
+
+def toExportBonePositions(mat, bone_quaternions, pos_orig, heads_curr):
+    """Create exportable bone positions by creating a difference transform from neutral state."""
+    pos_curr = transformPositions(mat, heads_curr)
     # If original position is neutralized later, can simply return current position as-is.
-    return (bone_quaternion.to_matrix() @ (-pos_orig)) + pos_curr
+    return np.einsum("bij,bj->bi", quaternionsToMatrices(bone_quaternions), -pos_orig) + pos_curr
+
+def meshGetVertexCoordinates(msh, mesh_scale):
+    """Reads all vertex coordinates of a mesh in one go, multiplied by mesh scale."""
+    # Buffer type must match the float property for foreach_get to copy it as raw memory.
+    co = np.empty(len(msh.vertices) * 3, dtype=np.float32)
+    msh.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3).astype(np.float64) * np.array(mesh_scale)
 
 def meshFindMaxVertexValue(msh, mesh_scale):
     """Finds greatest vertex value in mesh."""
-    ret = 0.0
-    for ii in msh.vertices:
-        px = abs(ii.co[0] * mesh_scale[0])
-        py = abs(ii.co[1] * mesh_scale[1])
-        pz = abs(ii.co[2] * mesh_scale[2])
-        ret = max(max(max(px, py), pz), ret)
-    return ret
+    return float(np.abs(meshGetVertexCoordinates(msh, mesh_scale)).max(initial=0.0))
 
-def meshVertexDataToString(msh, mesh_scale, export_scale):
-    """Converts mesh vertex data to string."""
+def meshMaterialColorsToStrings(msh):
+    """Converts mesh material colors to strings appended to triangles."""
     ret = []
-    for ii in msh.vertices:
-        px = toExportS16(ii.co[0] * mesh_scale[0] * export_scale)
-        py = toExportS16(ii.co[1] * mesh_scale[1] * export_scale)
-        pz = toExportS16(ii.co[2] * mesh_scale[2] * export_scale)
-        ret += ["%s%i, %i, %i," % (g_indent, px, py, pz)]
-    return "\n".join(ret)
-
-def meshTriangleToString(msh, face, idx1, idx2, idx3):
-    """Create string for one triangle with given vertices."""
-    vv = face.vertices
-    if (len(msh.materials) > 0) and msh.materials[face.material_index]:
-        color = msh.materials[face.material_index].diffuse_color
-        cr = toExportU8(color[0] * 255.0)
-        cg = toExportU8(color[1] * 255.0)
-        cb = toExportU8(color[2] * 255.0)
-        return "%s%i, %i, %i, %i, %i, %i," % (g_indent, vv[idx1], vv[idx2], vv[idx3], cr, cg, cb)
-    return "%s%i, %i, %i," % (g_indent, vv[idx1], vv[idx2], vv[idx3])
-
-def meshIndexDataToString(msh):
-    """Converts mesh index data to string."""
-    ret = []
-    for ii in msh.polygons:
-        # Fan out all higher-order polygons.
-        for jj in range(2, len(ii.vertices)):
-            ret += [meshTriangleToString(msh, ii, 0, jj - 1, jj)]
-    return "\n".join(ret)
+    for ii in msh.materials:
+        if ii:
+            color = ii.diffuse_color
+            cr = toExportU8(color[0] * 255.0)
+            cg = toExportU8(color[1] * 255.0)
+            cb = toExportU8(color[2] * 255.0)
+            ret.append(" %i, %i, %i," % (cr, cg, cb))
+        else:
+            ret.append("")
+    return ret
 
-def normalizedWeightData(data, vmap):
-    """Turns sorted weight data block into a normalized mode."""
-    # First convert existing references.
-    for ii in data:
-        ii[1] = vmap[ii[1]]
-    # Then add empty stubs before sorting.
-    while 3 > len(data):
-        data += [(0.0, 0)]
-    data = sorted(data, key = lambda x: x[0], reverse = True)
-    total_weight = 0.0
-    for ii in data:
-        total_weight += ii[0]
-    w1 = toExportU8(data[0][0] * 255.0 / total_weight)
-    w2 = toExportU8(data[1][0] * 255.0 / total_weight)
-    w3 = toExportU8(data[2][0] * 255.0 / total_weight)
-    return "%s%i, %i, %i, %i, %i, %i," % (g_indent, w1, w2, w3, data[0][1], data[1][1], data[2][1])
-
-def meshWeightDataToString(msh, vmap):
-    """Convert mesh group and weight data to strings."""
+def meshGetTriangles(msh):
+    """Get mesh triangle vertex indices and polygon indices of every triangle."""
+    polygon_count = len(msh.polygons)
+    # Buffer types must match the int properties for foreach_get to copy them as raw memory.
+    starts = np.empty(polygon_count, dtype=np.int32)
+    msh.polygons.foreach_get("loop_start", starts)
+    counts = np.empty(polygon_count, dtype=np.int32)
+    msh.polygons.foreach_get("loop_total", counts)
+    loops = np.empty(len(msh.loops), dtype=np.int32)
+    msh.loops.foreach_get("vertex_index", loops)
+    # Fan out all higher-order polygons, loop offsets are widened for the arithmetic.
+    (starts, counts) = (starts.astype(np.int64), counts.astype(np.int64))
+    triangle_counts = counts - 2
+    polygons = np.repeat(np.arange(polygon_count), triangle_counts)
+    first = starts[polygons]
+    offsets = np.arange(len(polygons)) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts) + 1
+    triangles = np.stack((loops[first], loops[first + offsets], loops[first + offsets + 1]), axis=1)
+    return (triangles, polygons)
+
+def meshOptimizeTriangleOrder(triangles, vertex_count, cache_size=16):
+    """Get triangle order optimized for post-transform vertex cache (Tipsify)."""
+    triangle_list = triangles.tolist()
+    # Triangles adjacent to every vertex.
+    adjacency = [[] for ii in range(vertex_count)]
+    for (ii, tri) in enumerate(triangle_list):
+        for jj in tri:
+            adjacency[jj].append(ii)
+    live = [len(ii) for ii in adjacency]
+    timestamps = [0] * vertex_count
+    emitted = [False] * len(triangle_list)
+    dead_end = []
     ret = []
-    for ii in msh.vertices:
-        grp = []
-        for jj in ii.groups:
-            # Check for aberrations.
-            if 0.0 > jj.weight:
-                raise RuntimeError("invalid vertex weight: %f" % (jj.weight))
-            grp += [[jj.weight, jj.group]]
-        ret += [normalizedWeightData(grp, vmap)]
-    return "\n".join(ret)
-
-def meshToString(msh, vmap, name, mesh_scale, export_scale):
+    time = cache_size + 1
+    cursor = 0
+    fanning = 0
+    while fanning >= 0:
+        candidates = []
+        for ii in adjacency[fanning]:
+            if emitted[ii]:
+                continue
+            for jj in triangle_list[ii]:
+                dead_end.append(jj)
+                candidates.append(jj)
+                live[jj] -= 1
+                if time - timestamps[jj] > cache_size:
+                    timestamps[jj] = time
+                    time += 1
+            emitted[ii] = True
+            ret.append(ii)
+        # Prefer vertices that will still be in cache after their remaining triangles have been emitted.
+        fanning = -1
+        best = -1
+        for ii in candidates:
+            if live[ii] > 0:
+                priority = 0
+                if time - timestamps[ii] + 2 * live[ii] <= cache_size:
+                    priority = time - timestamps[ii]
+                if priority > best:
+                    best = priority
+                    fanning = ii
+        # No candidates, skip to recently used vertices or any vertex that still has triangles.
+        while (0 > fanning) and dead_end:
+            ii = dead_end.pop()
+            if live[ii] > 0:
+                fanning = ii
+        while (0 > fanning) and (cursor < vertex_count):
+            if live[cursor] > 0:
+                fanning = cursor
+            cursor += 1
+    return np.array(ret, dtype=np.int64)
+
+def meshOptimizeVertexOrder(triangles, vertex_count):
+    """Get vertex order in which vertices are first referenced by triangles, unreferenced vertices last."""
+    first_use = np.full(vertex_count, len(triangles) * 3, dtype=np.int64)
+    flat = triangles.ravel()
+    # Unique returns the index of the first occurrence of every referenced vertex.
+    (referenced, first_index) = np.unique(flat, return_index=True)
+    first_use[referenced] = first_index
+    return np.argsort(first_use, kind="stable")
+
+def meshDataToStrings(msh, vmap, mesh_scale, export_scale, quantize_offsets, byte_vertices, optimize_order):
+    """Converts mesh vertex, index and weight data to strings in one traversal of vertices and polygons."""
+    vertex_count = len(msh.vertices)
+    # Index data comes from a single pass over polygons.
+    (triangles, polygons) = meshGetTriangles(msh)
+    # Reorder triangles for vertex cache and vertices for fetch locality, vertex data is permuted to match.
+    vertex_order = None
+    if optimize_order and len(triangles):
+        triangle_order = meshOptimizeTriangleOrder(triangles, vertex_count)
+        (triangles, polygons) = (triangles[triangle_order], polygons[triangle_order])
+        vertex_order = meshOptimizeVertexOrder(triangles, vertex_count)
+        remap = np.empty(vertex_count, dtype=np.int64)
+        remap[vertex_order] = np.arange(vertex_count)
+        triangles = remap[triangles]
+    co = meshGetVertexCoordinates(msh, mesh_scale) * export_scale
+    if vertex_order is not None:
+        co = co[vertex_order]
+    quantization = None
+    if quantize_offsets and vertex_count:
+        # Quantize relative to per-axis bounds to use the full range on every axis.
+        vertex_range = 255.0 if byte_vertices else 65535.0
+        lo = co.min(axis=0)
+        hi = co.max(axis=0)
+        step = np.where(hi > lo, (hi - lo) / vertex_range, 1.0)
+        vdata = toExportString(np.clip(np.rint((co - lo) / step), 0, vertex_range).astype(np.int32))
+        quantization = (lo, step, "uint8_t" if byte_vertices else "uint16_t")
+    elif byte_vertices and vertex_count:
+        # Signed 8-bit vertices share one step on all axes, fitting the greatest vertex value.
+        max_value = float(np.abs(co).max())
+        step = np.repeat(max_value / 127.0 if max_value > 0.0 else 1.0, 3)
+        vdata = toExportString(np.clip(np.rint(co / step), -127, 127).astype(np.int32))
+        quantization = (np.zeros(3), step, "int8_t")
+    else:
+        vdata = toExportString(np.clip(np.rint(co), -32768, 32767).astype(np.int16))
+    # Weight data only exists for meshes with armatures, collect it in the same vertex pass.
+    wdata = ""
+    if vmap and vertex_count:
+        # Group references are variable-length per vertex, gather them into flat arrays.
+        counts = []
+        weights = []
+        groups = []
+        for vv in msh.vertices:
+            vertex_groups = vv.groups
+            counts.append(len(vertex_groups))
+            for jj in vertex_groups:
+                weights.append(jj.weight)
+                groups.append(jj.group)
+        weights = np.array(weights, dtype=np.float64)
+        # Check for aberrations.
+        if np.any(0.0 > weights):
+            raise RuntimeError("invalid vertex weight: %f" % (weights[np.argmax(0.0 > weights)]))
+        group_map = np.array([vmap[ii] for ii in range(len(vmap))], dtype=np.int64)
+        groups = group_map[np.array(groups, dtype=np.int64)]
+        # Add empty stubs so every vertex has at least three references.
+        vertices = np.concatenate((np.repeat(np.arange(vertex_count), counts), np.repeat(np.arange(vertex_count), 3)))
+        weights = np.concatenate((weights, np.zeros(vertex_count * 3)))
+        groups = np.concatenate((groups, np.zeros(vertex_count * 3, dtype=np.int64)))
+        # Sort by vertex and descending weight, stubs stay behind existing references of same weight.
+        order = np.lexsort((np.arange(len(vertices)), -weights, vertices))
+        (vertices, weights, groups) = (vertices[order], weights[order], groups[order])
+        starts = np.searchsorted(vertices, np.arange(vertex_count))
+        total_weights = np.add.reduceat(weights, starts)
+        if not np.all(total_weights > 0.0):
+            raise RuntimeError("vertex %i has no weights" % (np.argmin(total_weights > 0.0)))
+        # Only three greatest references are exported.
+        selected = (np.arange(len(vertices)) - starts[vertices]) < 3
+        weights = weights[selected].reshape(-1, 3) * 255.0 / total_weights[:, np.newaxis]
+        weights = np.clip(np.rint(weights), 0, 255).astype(np.int64)
+        wdata = np.hstack((weights, groups[selected].reshape(-1, 3)))
+        if vertex_order is not None:
+            wdata = wdata[vertex_order]
+        wdata = toExportString(wdata)
+    # Colors are constant per material, only convert them once.
+    colors = meshMaterialColorsToStrings(msh)
+    if colors:
+        materials = np.empty(len(msh.polygons), dtype=np.int32)
+        msh.polygons.foreach_get("material_index", materials)
+        idata = toExportString(triangles, [colors[ii] for ii in materials[polygons].tolist()])
+    else:
+        idata = toExportString(triangles)
+    return (vdata, idata, wdata, quantization)
+
+def meshToString(msh, vmap, name, mesh_scale, export_scale, quantize_offsets, byte_vertices, optimize_order):
     """Returns C++ code string from a mesh."""
+    (vdata, idata, wdata, quantization) = meshDataToStrings(msh, vmap, mesh_scale, export_scale, quantize_offsets,
+            byte_vertices, optimize_order)
     subst = {
             "MODEL_NAME" : name,
-            "VERTEX_DATA" : meshVertexDataToString(msh, mesh_scale, export_scale),
+            "VERTEX_TYPE" : "int16_t",
+            "VERTEX_DATA" : vdata,
             "INDEX_TYPE" : "uint16_t",
-            "INDEX_DATA" : meshIndexDataToString(msh)
+            "INDEX_DATA" : idata
             }
     # May need larger index type.
     if len(msh.vertices) >= 65536:
         subst["INDEX_TYPE"] = "uint32_t"
-    ret = g_template_mesh.format(subst)
+    # Quantized vertices are decoded with per-axis offset and step.
+    if quantization:
+        subst["VERTEX_TYPE"] = quantization[2]
+    ret = [g_template_mesh.format(subst)]
+    if quantization:
+        qsubst = {
+                "MODEL_NAME" : name,
+                "OFFSET_DATA" : "%s%.9g, %.9g, %.9g," % ((g_indent,) + tuple(quantization[0].tolist())),
+                "STEP_DATA" : "%s%.9g, %.9g, %.9g," % ((g_indent,) + tuple(quantization[1].tolist())),
+                }
+        ret.append(g_template_vertex_quantization.format(qsubst))
     # May need to add weight data data for meshes with armatures.
-    if vmap:
-        wdata = meshWeightDataToString(msh, vmap)
-        if wdata:
-            return ret + "\n\n" + g_template_weights.format({"MODEL_NAME" : name, "WEIGHT_DATA" : wdata})
-    return ret
+    if wdata:
+        ret.append(g_template_weights.format({"MODEL_NAME" : name, "WEIGHT_DATA" : wdata}))
+    return "\n\n".join(ret)
 
 def armatureBoneDataToString(arm, mat, armature_scale, export_scale):
     """Converts armature bone data to string."""
-    ret = []
-    for ii in arm.bones:
-        hd = mat @ ii.head_local
-        hd[0] = toExportS16(hd[0] * armature_scale[0] * export_scale)
-        hd[1] = toExportS16(hd[1] * armature_scale[1] * export_scale)
-        hd[2] = toExportS16(hd[2] * armature_scale[2] * export_scale)
-        ret += ["%s%i, %i, %i," % (g_indent, hd[0], hd[1], hd[2])]
-    return "\n".join(ret)
-
-def findBoneIndex(arm, bone):
-    """Find index of given bone in an armature."""
-    for ii in range(len(arm.bones)):
-        if arm.bones[ii] == bone:
-            return ii
-    return -1
+    hd = transformPositions(mat, getBoneVectors(arm.bones, "head_local"))
+    return toExportString(np.clip(np.rint(hd * np.array(armature_scale) * export_scale), -32768, 32767).astype(np.int32))
 
 def armatureBoneHierarchyToString(arm):
     """Converts armature relation data to string."""
     ret = []
+    bone_indices = {bone.name : ii for (ii, bone) in enumerate(arm.bones)}
     for ii in arm.bones:
-        child_list = "%s%i," % (g_indent, len(ii.children))
+        child_list = ["%s%i," % (g_indent, len(ii.children))]
         for jj in ii.children:
-            idx = findBoneIndex(arm, jj)
+            idx = bone_indices.get(jj.name, -1)
             if 0 > idx:
                 raise RuntimeError("could not locate bone '%s' index" % (jj.name))
-            child_list += " %i," % (idx)
-        ret += [child_list]
+            child_list.append(" %i," % (idx))
+        ret.append("".join(child_list))
     return "\n".join(ret)
 
 def armatureToString(arm, name, mat, armature_scale, export_scale):
     """Returns C++ code string from an armature."""
-    tmpl = copy.deepcopy(g_template_armature)
     subst = {
             "MODEL_NAME" : name,
             "BONE_DATA" : armatureBoneDataToString(arm, mat, armature_scale, export_scale),
@@ -334,16 +553,28 @@ def getArmatureOrdering(arm):
     """Get mapping from armature names to indices."""
     ret = []
     for ii in arm.bones:
-        ret += [ii.name]
+        ret.append(ii.name)
     return ret
 
 def getVertexGroupOrdering(msh, amap):
     """Get vertex group transform for given mesh and armature map."""
-    ret = {}
-    for ii in range(len(msh.vertex_groups)):
-        grp = msh.vertex_groups[ii]
-        ret[ii] = amap.index(grp.name)
-    return ret
+    bone_indices = {name : ii for (ii, name) in enumerate(amap)}
+    return {ii : bone_indices[grp.name] for (ii, grp) in enumerate(msh.vertex_groups)}
+
+def findExportObjects(context):
+    """Finds the first mesh and the first armature in a context in a single pass."""
+    msh = None
+    arm = None
+    for ii in context.selectable_objects:
+        if not isExportName(ii.name):
+            continue
+        if (not msh) and ("MESH" == ii.type):
+            msh = ii
+        elif (not arm) and ("ARMATURE" == ii.type):
+            arm = ii
+        if msh and arm:
+            break
+    return (msh, arm)
 
 def findArmature(context):
     """Finds the first armature in a context."""
@@ -360,55 +591,68 @@ def collectPoses(pl):
         basename = pose.getName()
         if not basename in ret:
             ret[basename] = []
-        ret[basename] += [pose]
+        ret[basename].append(pose)
     for kk in ret.keys():
-        ret[kk] = sorted(ret[kk])
+        ret[kk] = sorted(ret[kk], key=Pose.getTime)
     return ret
 
-def animToString(context, anim, amap, arm, name, key_name, mat, armature_scale, export_scale):
+def getArmatureRestData(arm, mat):
+    """Get inverse rest matrices and transformed rest heads of armature bones."""
+    world = np.linalg.inv(getBoneMatrices(arm.data.bones, "matrix_local"))
+    pos_orig = transformPositions(mat, getBoneVectors(arm.data.bones, "head_local"))
+    return (world, pos_orig)
+
+def animToString(context, anim, amap, arm, rest, name, key_name, mat, armature_scale, export_scale, packed_rotations):
     """Exports singular animation to string."""
-    ret = []
+    # One line for timestamp and one line per bone for every pose.
+    bone_width = 5 if packed_rotations else 7
+    fmt = "\n".join(["%s%%i," % (g_indent)] + [g_indent + ", ".join(["%i"] * bone_width) + ","] * len(amap))
+    # Rest pose data does not change between poses, amap is already in armature order.
+    (world, pos_orig) = rest
+    # Pose bones are read in bulk, iterate them using armature order.
+    pose_order = [arm.pose.bones.find(jj) for jj in amap]
+    times = []
+    bones_curr = []
+    heads_curr = []
     for ii in anim:
-        ret += ["%s%i," % (g_indent, toExport8F8(ii.getTime()))]
         bpy.ops.poselib.apply_pose(pose_index=ii.getIndex())
-        # Iterate using armature order.
-        for jj in amap:
-            bone_orig = arm.data.bones[jj]
-            bone_curr = arm.pose.bones[jj]
-            # Heaven knows why we have to rearrange the quaternion order.
-            qq = toExportBoneQuaternion(bone_orig, bone_curr)
-            qw = toExport4F12(qq[0])
-            qx = toExport4F12(qq[1])
-            qy = toExport4F12(qq[2])
-            qz = toExport4F12(qq[3])
-            # The difference to original position is baked into the animation position.
-            hd = toExportBonePosition(mat, qq, bone_orig, bone_curr)
-            px = toExportS16(hd[0] * armature_scale[0] * export_scale)
-            py = toExportS16(hd[1] * armature_scale[1] * export_scale)
-            pz = toExportS16(hd[2] * armature_scale[2] * export_scale)
-            ret += ["%s%i, %i, %i, %i, %i, %i, %i," % (g_indent, px, py, pz, qw, qx, qy, qz)]
+        times.append(toExport8F8(ii.getTime()))
+        bones_curr.append(getBoneMatrices(arm.pose.bones, "matrix")[pose_order])
+        heads_curr.append(getBoneVectors(arm.pose.bones, "head")[pose_order])
+    # Convert bones of all poses at once.
+    pose_count = len(times)
+    bones_curr = np.array(bones_curr).reshape(-1, 4, 4)
+    heads_curr = np.array(heads_curr).reshape(-1, 3)
+    # Heaven knows why we have to rearrange the quaternion order.
+    qq = toExportBoneQuaternions(np.tile(world, (pose_count, 1, 1)), bones_curr)
+    if packed_rotations:
+        qd = toExportPackedQuaternions(qq)
+    else:
+        qd = np.rint(qq * 4096.0).astype(np.int32)
+    # The difference to original position is baked into the animation position.
+    hd = toExportBonePositions(mat, qq, np.tile(pos_orig, (pose_count, 1)), heads_curr)
+    pd = np.clip(np.rint(hd * np.array(armature_scale) * export_scale), -32768, 32767).astype(np.int32)
+    data = np.hstack((np.array(times, dtype=np.int32).reshape(-1, 1), np.hstack((pd, qd)).reshape(pose_count, -1)))
+    ret = "\n".join([fmt] * pose_count) % tuple(data.ravel().tolist())
     subst = {
-            "ANIM_DATA" : "\n".join(ret),
+            "ANIM_DATA" : ret,
             "MODEL_NAME" : name,
             "ANIM_NAME" : key_name,
             }
+    if packed_rotations:
+        return g_template_anim_packed.format(subst)
     return g_template_anim.format(subst)
 
-def exportAllMeshesToHeader(filename, context):
+def exportAllMeshesToHeader(filename, context, packed_rotations=False, quantize_offsets=False, byte_vertices=False,
+        optimize_order=False):
     export_strings = []
-    # Find mesh.
-    msh = None
-    for ii in context.selectable_objects:
-        if isExportName(ii.name) and ("MESH" == ii.type):
-            msh = ii
-            break
+    # Find mesh and armature.
+    (msh, arm) = findExportObjects(context)
     if not msh:
         raise RuntimeError("could not find mesh to export")
     vgl_log("selected mesh for export: '%s'" % (msh.name))
     # Everything needs to be exported in the same scale, discard two bits of accuracy and fit in int16_t.
     export_scale = 32767.0 / (meshFindMaxVertexValue(msh.data, msh.scale) * 4.0)
-    # Find armature.
-    arm = findArmature(context)
     # Export armature.
     if arm:
         # Not having scale 1 is suspicious.
@@ -418,25 +662,29 @@ def exportAllMeshesToHeader(filename, context):
         exp_name = toExportName(arm.name)
         amap = getArmatureOrdering(arm.data)
         vgl_log("bone mapping: %s" % (str(amap)))
-        export_strings += [armatureToString(arm.data, exp_name, arm.matrix_basis, arm.scale, export_scale)]
+        export_strings.append(armatureToString(arm.data, exp_name, arm.matrix_basis, arm.scale, export_scale))
         # Animations in armatures.
         if hasattr(arm, "pose_library") and arm.pose_library:
             anims = collectPoses(arm.pose_library)
+            # Rest data is shared by all animations.
+            rest = getArmatureRestData(arm, arm.matrix_basis)
             for (kk, vv) in anims.items():
-                export_strings += [animToString(context, vv, amap, arm, exp_name, kk, arm.matrix_basis, arm.scale, export_scale)]
+                export_strings.append(animToString(context, vv, amap, arm, rest, exp_name, kk, arm.matrix_basis, arm.scale, export_scale, packed_rotations))
     # Export mesh.
     vmap = None
     if arm:
         vmap = getVertexGroupOrdering(msh, amap)
         vgl_log("vertex mapping: %s" % (str(vmap)))
     export_name = toExportName(msh.name)
-    export_strings += [meshToString(msh.data, vmap, export_name, msh.scale, export_scale)]
-    with open(filename, "w") as fd:
+    export_strings.append(meshToString(msh.data, vmap, export_name, msh.scale, export_scale, quantize_offsets,
+            byte_vertices, optimize_order))
+    # Write in binary mode with a large buffer, header data is plain text anyway.
+    with open(filename, "wb", buffering=g_write_buffer_size) as fd:
         subst = {
                 "MODEL_DATA" : "\n\n".join(export_strings),
                 "HEADER_NAME" : "__" + os.path.basename(filename).replace(".", "_").lower() + "__",
                 }
-        fd.write(g_template_header.format(subst))
+        g_template_header.write(fd, subst)
 
 ########################################
 # Blender animation panel ##############
@@ -533,9 +781,18 @@ class VglOperatorExport(Operator, ExportHelper):
 
     filter_glob: StringProperty(default="*.hpp", options={'HIDDEN'})
 
+    packed_rotations: BoolProperty(name="Packed rotations", description="Export bone rotations in 10-10-10-2 smallest three format, halving their size at about 0.2 degree precision", default=False)
+
+    quantize_offsets: BoolProperty(name="Per-axis vertex quantization", description="Export vertices as unsigned offsets within per-axis bounds, using full 16-bit range on every axis", default=False)
+
+    byte_vertices: BoolProperty(name="8-bit vertices", description="Export vertices as 8-bit values, halving their size at the cost of precision", default=False)
+
+    optimize_order: BoolProperty(name="Optimize vertex order", description="Reorder triangles for vertex cache and vertices for fetch locality", default=False)
+
     def execute(self, context):
         filu = self.filepath
-        exportAllMeshesToHeader(filu, context)
+        exportAllMeshesToHeader(filu, context, self.packed_rotations, self.quantize_offsets, self.byte_vertices,
+                self.optimize_order)
         return {"FINISHED"}
 
 def vgl_menu_export(self, context):
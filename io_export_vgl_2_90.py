@@ -16,7 +16,8 @@ http://faemiyah.fi/demoscene/vgl
 """
 
 import bpy
-import copy
+import functools
+import numpy as np
 import os
 import re
 from mathutils import Vector
@@ -53,27 +54,42 @@ def vgl_log(op):
 # Templates ############################
 ########################################
 
+g_regex_template_key = re.compile(r'\[\[\s*([^\]]+?)\s*\]\]')
+
 class Template:
     """Class for templated string generation."""
 
     def __init__(self, content):
         """Constructor."""
         self.__content = content
+        # Split into literals and substitution keys only once, every odd element is a key.
+        self.__segments = g_regex_template_key.split(content)
+        self.__keys = self.__segments[1::2]
+        self.__key_set = frozenset(self.__keys)
+
+    def substitute(self, substitutions=None):
+        """Return formatted output as a list of segments."""
+        if not substitutions:
+            substitutions = {}
+        for kk in substitutions:
+            if not kk in self.__key_set:
+                print("WARNING: substitution '%s' has no matches" % (kk))
+        if is_verbose():
+            unmatched = [kk for kk in self.__keys if not kk in substitutions]
+            if unmatched:
+                print("Template substitutions not matched: %s (%i)" % (str(list(set(unmatched))), len(unmatched)))
+        ret = list(self.__segments)
+        ret[1::2] = [substitutions.get(kk, "") for kk in self.__keys]
+        return ret
 
     def format(self, substitutions=None):
         """Return formatted output."""
-        ret = self.__content
-        if substitutions:
-            for kk in substitutions:
-                vv = substitutions[kk].replace("\\", "\\\\")
-                (ret, num) = re.subn(r'\[\[\s*%s\s*\]\]' % (kk), vv, ret)
-                if not num:
-                    print("WARNING: substitution '%s' has no matches" % (kk))
-        unmatched = list(set(re.findall(r'\[\[([^\]]+)\]\]', ret)))
-        (ret, num) = re.subn(r'\[\[[^\]]+\]\]', "", ret)
-        if num and is_verbose():
-            print("Template substitutions not matched: %s (%i)" % (str(unmatched), num))
-        return ret
+        return "".join(self.substitute(substitutions))
+
+    def write(self, fd, substitutions=None):
+        """Write formatted output into a binary file segment by segment."""
+        for ii in self.substitute(substitutions):
+            fd.write(ii.encode("utf-8"))
 
     def __str__(self):
         """String representation."""
@@ -107,6 +123,8 @@ uint8_t g_armature_[[MODEL_NAME]][] =
 [[ARMATURE_DATA]]
 };""")
 
+g_template_bone_scale = Template("""const float g_bone_scale_[[MODEL_NAME]] = [[BONE_SCALE]];""")
+
 g_template_anim = Template("""int16_t g_animation_[[MODEL_NAME]]_[[ANIM_NAME]][] =
 {
 [[ANIM_DATA]]
@@ -114,6 +132,8 @@ g_template_anim = Template("""int16_t g_animation_[[MODEL_NAME]]_[[ANIM_NAME]][]
 
 g_indent = "  "
 
+g_write_buffer_size = 128 * 1024
+
 ########################################
 # Pose #################################
 ########################################
@@ -158,10 +178,12 @@ def isExportName(name):
     """Tell if named object wants to be exported."""
     return name.startswith("g_")
 
+g_regex_export_name = re.compile(r'[\.\s]')
+
+@functools.lru_cache(maxsize=None)
 def toExportName(name):
     """Convert name to .cpp -friendly name."""
-    ret = re.sub(r'\.', r'_', name)
-    return re.sub(r'\s', r'_', ret)
+    return g_regex_export_name.sub(r'_', name)
 
 def toExport8F8(op):
     """Converts number to exportable 8.8 signed fixed point number."""
@@ -179,102 +201,202 @@ def toExportU8(op):
     """Converts number to exportable unsigned 8-bit number."""
     return max(min(int(round(op)), 255), 0)
 
+def toExport8F8Array(op):
+    """Converts array to exportable 8.8 signed fixed point numbers."""
+    return np.rint(op * 256.0).astype(np.int32)
+
+def toExport4F12Array(op):
+    """Converts array to exportable 4.12 signed fixed point numbers."""
+    return np.rint(op * 4096.0).astype(np.int32)
+
+def toExportS16Array(op):
+    """Converts array to exportable signed 16-bit numbers."""
+    return np.clip(np.rint(op), -32768, 32767).astype(np.int32)
+
+def toExportU8Array(op):
+    """Converts array to exportable unsigned 8-bit numbers."""
+    return np.clip(np.rint(op), 0, 255).astype(np.int32)
+
+def toExportString(data, suffixes=None):
+    """Converts rows of an integer array to C++ array lines, formatting everything at once."""
+    line = g_indent + ", ".join(["%i"] * data.shape[1]) + ","
+    if suffixes:
+        fmt = "\n".join([line + ii for ii in suffixes])
+    else:
+        fmt = "\n".join([line] * len(data))
+    return fmt % tuple(data.ravel().tolist())
+
 def findRootBone(bone):
     """Find bone root."""
-    if not bone.parent:
-        return bone
-    return findRootBone(bone.parent)
-
-def toExportBoneQuaternion(bone_orig, bone_curr):
-    """Create exportable bone oritentation by undoing Blender's bone transform mangling."""
-    world = bone_orig.matrix_local.inverted()
-    qq = (bone_curr.matrix @ world).to_quaternion()
-    return qq
-
-def toExportBonePosition(mat, bone_quaternion, bone_orig, bone_curr):
-    """Create exportable bone position by creating a difference transform from neutral state."""
-    pos_orig = mat @ bone_orig.head_local
-    pos_curr = mat @ bone_curr.head
+    while bone.parent:
+        bone = bone.parent
+    return bone
+
+def getBoneMatrices(bones, attr):
+    """Reads given matrix attribute of all bones into an array of row-major matrices."""
+    # Buffer type must match the float property for foreach_get to copy it as raw memory.
+    ret = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get(attr, ret)
+    # Blender hands out matrices in column-major order.
+    return ret.astype(np.float64).reshape(-1, 4, 4).transpose(0, 2, 1)
+
+def getBoneVectors(bones, attr):
+    """Reads given vector attribute of all bones into an array."""
+    ret = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get(attr, ret)
+    return ret.astype(np.float64).reshape(-1, 3)
+
+def matricesToQuaternions(mats):
+    """Converts rotation part of matrices to quaternions, branching the same way as Matrix.to_quaternion()."""
+    mm = mats[:, :3, :3]
+    mm = mm / np.linalg.norm(mm, axis=1, keepdims=True)
+    (m00, m01, m02) = (mm[:, 0, 0], mm[:, 0, 1], mm[:, 0, 2])
+    (m10, m11, m12) = (mm[:, 1, 0], mm[:, 1, 1], mm[:, 1, 2])
+    (m20, m21, m22) = (mm[:, 2, 0], mm[:, 2, 1], mm[:, 2, 2])
+    ret = np.empty((len(mm), 4), dtype=np.float64)
+    tr = 0.25 * (1.0 + m00 + m11 + m22)
+    sel_w = tr > 1e-4
+    sel_x = ~sel_w & (m00 > m11) & (m00 > m22)
+    sel_y = ~sel_w & ~sel_x & (m11 > m22)
+    sel_z = ~sel_w & ~sel_x & ~sel_y
+    # Errors from square roots of negative numbers are discarded by the selection.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sw = np.sqrt(tr)
+        sx = 2.0 * np.sqrt(1.0 + m00 - m11 - m22)
+        sy = 2.0 * np.sqrt(1.0 + m11 - m00 - m22)
+        sz = 2.0 * np.sqrt(1.0 + m22 - m00 - m11)
+        ret[sel_w] = np.stack((sw, (m21 - m12) / (4.0 * sw), (m02 - m20) / (4.0 * sw), (m10 - m01) / (4.0 * sw)), axis=1)[sel_w]
+        ret[sel_x] = np.stack(((m21 - m12) / sx, 0.25 * sx, (m01 + m10) / sx, (m02 + m20) / sx), axis=1)[sel_x]
+        ret[sel_y] = np.stack(((m02 - m20) / sy, (m01 + m10) / sy, 0.25 * sy, (m12 + m21) / sy), axis=1)[sel_y]
+        ret[sel_z] = np.stack(((m10 - m01) / sz, (m02 + m20) / sz, (m12 + m21) / sz, 0.25 * sz), axis=1)[sel_z]
+    return ret / np.linalg.norm(ret, axis=1, keepdims=True)
+
+def quaternionsToMatrices(quaternions):
+    """Converts quaternions to 3x3 rotation matrices."""
+    (qw, qx, qy, qz) = (quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3])
+    return np.stack((
+        np.stack((1.0 - 2.0 * (qy * qy + qz * qz), 2.0 * (qx * qy - qz * qw), 2.0 * (qx * qz + qy * qw)), axis=1),
+        np.stack((2.0 * (qx * qy + qz * qw), 1.0 - 2.0 * (qx * qx + qz * qz), 2.0 * (qy * qz - qx * qw)), axis=1),
+        np.stack((2.0 * (qx * qz - qy * qw), 2.0 * (qy * qz + qx * qw), 1.0 - 2.0 * (qx * qx + qy * qy)), axis=1),
+        ), axis=1)
+
+def transformPositions(mat, positions):
+    """Transforms an array of positions with a 4x4 matrix."""
+    mm = np.array(mat)
+    return positions @ mm[:3, :3].T + mm[:3, 3]
+
+def toExportBoneQuaternions(world, bones_curr):
+    """Create exportable bone oritentations by undoing Blender's bone transform mangling."""
+    return matricesToQuaternions(bones_curr @ world)
+
+def toExportBonePositions(mat, bone_quaternions, pos_orig, heads_curr):
+    """Create exportable bone positions by creating a difference transform from neutral state."""
+    pos_curr = transformPositions(mat, heads_curr)
     # If original position is neutralized later, can simply return current position as-is.
-    return (bone_quaternion.to_matrix() @ (-pos_orig)) + pos_curr
+    return np.einsum("bij,bj->bi", quaternionsToMatrices(bone_quaternions), -pos_orig) + pos_curr
 
-def meshFindMaxVertexValue(msh, mesh_scale):
-    """Finds greatest vertex value in mesh."""
-    ret = 0.0
-    for ii in msh.vertices:
-        px = abs(ii.co[0] * mesh_scale[0])
-        py = abs(ii.co[1] * mesh_scale[1])
-        pz = abs(ii.co[2] * mesh_scale[2])
-        ret = max(max(max(px, py), pz), ret)
-    return ret
+def meshGetVertexCoordinates(msh, mesh_scale):
+    """Reads all vertex coordinates of a mesh in one go, multiplied by mesh scale."""
+    # Buffer type must match the float property for foreach_get to copy it as raw memory.
+    co = np.empty(len(msh.vertices) * 3, dtype=np.float32)
+    msh.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3).astype(np.float64) * np.array(mesh_scale)
+
+def meshFindMaxVertexValue(co):
+    """Finds greatest vertex value in mesh coordinates."""
+    return float(np.abs(co).max(initial=0.0))
 
-def meshVertexDataToString(msh, mesh_scale, export_scale):
-    """Converts mesh vertex data to string."""
+def meshVertexDataToString(co, export_scale):
+    """Converts mesh vertex coordinates to string."""
+    return toExportString(toExportS16Array(co * export_scale))
+
+def meshMaterialColorsToStrings(context, msh):
+    """Converts mesh material colors to strings appended to triangles."""
     ret = []
-    for ii in msh.vertices:
-        px = toExportS16(ii.co[0] * mesh_scale[0] * export_scale)
-        py = toExportS16(ii.co[1] * mesh_scale[1] * export_scale)
-        pz = toExportS16(ii.co[2] * mesh_scale[2] * export_scale)
-        ret += ["%s%i, %i, %i," % (g_indent, px, py, pz)]
-    return "\n".join(ret)
+    for ii in msh.materials:
+        if ii and context.scene.vgl_export_color:
+            color = ii.diffuse_color
+            cr = toExportU8(color[0] * 255.0)
+            cg = toExportU8(color[1] * 255.0)
+            cb = toExportU8(color[2] * 255.0)
+            ret.append(" %i, %i, %i," % (cr, cg, cb))
+        else:
+            ret.append("")
+    return ret
 
-def meshTriangleToString(context, msh, face, idx1, idx2, idx3):
-    """Create string for one triangle with given vertices."""
-    vv = face.vertices
-    if (len(msh.materials) > 0) and msh.materials[face.material_index] and context.scene.vgl_export_color:
-        color = msh.materials[face.material_index].diffuse_color
-        cr = toExportU8(color[0] * 255.0)
-        cg = toExportU8(color[1] * 255.0)
-        cb = toExportU8(color[2] * 255.0)
-        return "%s%i, %i, %i, %i, %i, %i," % (g_indent, vv[idx1], vv[idx2], vv[idx3], cr, cg, cb)
-    return "%s%i, %i, %i," % (g_indent, vv[idx1], vv[idx2], vv[idx3])
+def meshGetTriangles(msh):
+    """Get mesh triangle vertex indices and polygon indices of every triangle."""
+    polygon_count = len(msh.polygons)
+    # Buffer types must match the int properties for foreach_get to copy them as raw memory.
+    starts = np.empty(polygon_count, dtype=np.int32)
+    msh.polygons.foreach_get("loop_start", starts)
+    counts = np.empty(polygon_count, dtype=np.int32)
+    msh.polygons.foreach_get("loop_total", counts)
+    loops = np.empty(len(msh.loops), dtype=np.int32)
+    msh.loops.foreach_get("vertex_index", loops)
+    # Fan out all higher-order polygons, loop offsets are widened for the arithmetic.
+    (starts, counts) = (starts.astype(np.int64), counts.astype(np.int64))
+    triangle_counts = counts - 2
+    polygons = np.repeat(np.arange(polygon_count), triangle_counts)
+    first = starts[polygons]
+    offsets = np.arange(len(polygons)) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts) + 1
+    triangles = np.stack((loops[first], loops[first + offsets], loops[first + offsets + 1]), axis=1)
+    return (triangles, polygons)
 
 def meshIndexDataToString(context, msh):
     """Converts mesh index data to string."""
-    ret = []
-    for ii in msh.polygons:
-        # Fan out all higher-order polygons.
-        for jj in range(2, len(ii.vertices)):
-            ret += [meshTriangleToString(context, msh, ii, 0, jj - 1, jj)]
-    return "\n".join(ret)
-
-def normalizedWeightData(data, vmap):
-    """Turns sorted weight data block into a normalized mode."""
-    # First convert existing references before sorting.
-    for ii in data:
-        ii[1] = vmap[ii[1]]
-    data = sorted(data, key = lambda x: x[0], reverse = True)
-    # Ensure data length is exactly 3.
-    while 3 > len(data):
-        data += [(0.0, 0)]
-    data = data[:3]
-    # Calculate total weights.
-    total_weight = 0.0
-    for ii in data:
-        total_weight += ii[0]
-    w1 = toExportU8(data[0][0] * 255.0 / total_weight)
-    w2 = toExportU8(data[1][0] * 255.0 / total_weight)
-    w3 = toExportU8(data[2][0] * 255.0 / total_weight)
-    return "%s%i, %i, %i, %i, %i, %i," % (g_indent, w1, w2, w3, data[0][1], data[1][1], data[2][1])
+    (triangles, polygons) = meshGetTriangles(msh)
+    # Colors are constant per material, only convert them once.
+    colors = meshMaterialColorsToStrings(context, msh)
+    if colors:
+        materials = np.empty(len(msh.polygons), dtype=np.int32)
+        msh.polygons.foreach_get("material_index", materials)
+        return toExportString(triangles, [colors[ii] for ii in materials[polygons].tolist()])
+    return toExportString(triangles)
 
 def meshWeightDataToString(msh, vmap):
     """Convert mesh group and weight data to strings."""
-    ret = []
+    vertex_count = len(msh.vertices)
+    if not vertex_count:
+        return ""
+    # Group references are variable-length per vertex, gather them into flat arrays.
+    counts = []
+    weights = []
+    groups = []
     for ii in msh.vertices:
-        grp = []
-        for jj in ii.groups:
-            # Check for aberrations.
-            if 0.0 > jj.weight:
-                raise RuntimeError("invalid vertex weight: %f" % (jj.weight))
-            grp += [[jj.weight, jj.group]]
-        ret += [normalizedWeightData(grp, vmap)]
-    return "\n".join(ret)
-
-def meshToString(context, msh, vmap, name, mesh_scale, export_scale):
-    """Returns C++ code string from a mesh."""
+        vertex_groups = ii.groups
+        counts.append(len(vertex_groups))
+        for jj in vertex_groups:
+            weights.append(jj.weight)
+            groups.append(jj.group)
+    weights = np.array(weights, dtype=np.float64)
+    # Check for aberrations.
+    if np.any(0.0 > weights):
+        raise RuntimeError("invalid vertex weight: %f" % (weights[np.argmax(0.0 > weights)]))
+    group_map = np.array([vmap[ii] for ii in range(len(vmap))], dtype=np.int64)
+    groups = group_map[np.array(groups, dtype=np.int64)]
+    # Add empty stubs so every vertex has at least three references.
+    vertices = np.concatenate((np.repeat(np.arange(vertex_count), counts), np.repeat(np.arange(vertex_count), 3)))
+    weights = np.concatenate((weights, np.zeros(vertex_count * 3)))
+    groups = np.concatenate((groups, np.zeros(vertex_count * 3, dtype=np.int64)))
+    # Sort by vertex and descending weight, stubs stay behind existing references of same weight.
+    order = np.lexsort((np.arange(len(vertices)), -weights, vertices))
+    (vertices, weights, groups) = (vertices[order], weights[order], groups[order])
+    # Only three greatest references are exported and normalized.
+    starts = np.searchsorted(vertices, np.arange(vertex_count))
+    selected = (np.arange(len(vertices)) - starts[vertices]) < 3
+    weights = weights[selected].reshape(-1, 3)
+    total_weights = weights.sum(axis=1)
+    if not np.all(total_weights > 0.0):
+        raise RuntimeError("vertex %i has no weights" % (np.argmin(total_weights > 0.0)))
+    weights = toExportU8Array(weights * 255.0 / total_weights[:, np.newaxis])
+    return toExportString(np.hstack((weights, groups[selected].reshape(-1, 3))))
+
+def meshToString(context, msh, co, vmap, name, export_scale):
+    """Returns C++ code string from a mesh and its scaled vertex coordinates."""
     subst = {
             "MODEL_NAME" : name,
-            "VERTEX_DATA" : meshVertexDataToString(msh, mesh_scale, export_scale),
+            "VERTEX_DATA" : meshVertexDataToString(co, export_scale),
             "INDEX_TYPE" : "uint16_t",
             "INDEX_DATA" : meshIndexDataToString(context, msh)
             }
@@ -291,38 +413,25 @@ def meshToString(context, msh, vmap, name, mesh_scale, export_scale):
 
 def armatureBoneDataToString(arm, mat, armature_scale, export_scale):
     """Converts armature bone data to string."""
-    ret = []
-    for ii in arm.bones:
-        hd = mat @ ii.head_local
-        hd[0] = toExportS16(hd[0] * armature_scale[0] * export_scale)
-        hd[1] = toExportS16(hd[1] * armature_scale[1] * export_scale)
-        hd[2] = toExportS16(hd[2] * armature_scale[2] * export_scale)
-        ret += ["%s%i, %i, %i," % (g_indent, hd[0], hd[1], hd[2])]
-    return "\n".join(ret)
-
-def findBoneIndex(arm, bone):
-    """Find index of given bone in an armature."""
-    for ii in range(len(arm.bones)):
-        if arm.bones[ii] == bone:
-            return ii
-    return -1
+    hd = transformPositions(mat, getBoneVectors(arm.bones, "head_local"))
+    return toExportString(toExportS16Array(hd * np.array(armature_scale) * export_scale))
 
 def armatureBoneHierarchyToString(arm):
     """Converts armature relation data to string."""
     ret = []
+    bone_indices = {bone.name : ii for (ii, bone) in enumerate(arm.bones)}
     for ii in arm.bones:
-        child_list = "%s%i," % (g_indent, len(ii.children))
+        child_list = ["%s%i," % (g_indent, len(ii.children))]
         for jj in ii.children:
-            idx = findBoneIndex(arm, jj)
+            idx = bone_indices.get(jj.name, -1)
             if 0 > idx:
                 raise RuntimeError("could not locate bone '%s' index" % (jj.name))
-            child_list += " %i," % (idx)
-        ret += [child_list]
+            child_list.append(" %i," % (idx))
+        ret.append("".join(child_list))
     return "\n".join(ret)
 
 def armatureToString(arm, name, mat, armature_scale, export_scale):
     """Returns C++ code string from an armature."""
-    tmpl = copy.deepcopy(g_template_armature)
     subst = {
             "MODEL_NAME" : name,
             "BONE_DATA" : armatureBoneDataToString(arm, mat, armature_scale, export_scale),
@@ -334,16 +443,13 @@ def getArmatureOrdering(arm):
     """Get mapping from armature names to indices."""
     ret = []
     for ii in arm.bones:
-        ret += [ii.name]
+        ret.append(ii.name)
     return ret
 
 def getVertexGroupOrdering(msh, amap):
     """Get vertex group transform for given mesh and armature map."""
-    ret = {}
-    for ii in range(len(msh.vertex_groups)):
-        grp = msh.vertex_groups[ii]
-        ret[ii] = amap.index(grp.name)
-    return ret
+    bone_indices = {name : ii for (ii, name) in enumerate(amap)}
+    return {ii : bone_indices[grp.name] for (ii, grp) in enumerate(msh.vertex_groups)}
 
 def findArmature(context):
     """Finds the first armature in a context."""
@@ -371,56 +477,94 @@ def collectPoses(pl):
         basename = pose.getName()
         if not basename in ret:
             ret[basename] = []
-        ret[basename] += [pose]
+        ret[basename].append(pose)
     for kk in ret.keys():
         ret[kk] = sorted(ret[kk])
     return ret
 
-def animToString(context, amap, arm, action, model_name, mat, armature_scale, export_scale):
-    """Exports singular animation to string."""
-    ret = []
-    # Assign action, iterate to first frame.
+def getActionFrames(action):
+    """Get sorted frames of all keyframes in an action."""
+    frames = [np.empty(0)]
+    for ii in action.fcurves:
+        # Buffer type must match the float property for foreach_get to copy it as raw memory.
+        co = np.empty(len(ii.keyframe_points) * 2, dtype=np.float32)
+        ii.keyframe_points.foreach_get("co", co)
+        frames.append(co[0::2])
+    return np.unique(np.rint(np.concatenate(frames)).astype(np.int64)).tolist()
+
+def getArmatureRestData(arm, mat):
+    """Get inverse rest matrices and transformed rest heads of armature bones."""
+    world = np.linalg.inv(getBoneMatrices(arm.data.bones, "matrix_local"))
+    pos_orig = transformPositions(mat, getBoneVectors(arm.data.bones, "head_local"))
+    return (world, pos_orig)
+
+def animGetFrames(context, amap, arm, rest, action, mat):
+    """Evaluates all keyframes of an action into frames, bone orientations and bone positions."""
+    # Rest pose data does not change between frames, amap is already in armature order.
+    (world, pos_orig) = rest
+    # Pose bones are read in bulk, iterate them using armature order.
+    pose_order = [arm.pose.bones.find(jj) for jj in amap]
+    # Keyframes are read directly from the action instead of jumping between them in the user interface.
+    frames = getActionFrames(action)
+    original_frame = context.scene.frame_current
+    # Zero-size arrays are not valid C++, export the current frame like jumping between keyframes would.
+    if not frames:
+        vgl_log("WARNING: action '%s' has no keyframes, exporting frame %i" % (action.name, original_frame))
+        frames = [original_frame]
     arm.animation_data.action = action
-    while True:
-        if bpy.ops.screen.keyframe_jump(next=False) != {"FINISHED"}:
-            break
-        bpy.ops.wm.redraw_timer(type="DRAW_WIN_SWAP", iterations=1)
-    # Go forward while saving frames.
-    while True:
-        # Action must be reassigned or the pose won't update.
-        arm.animation_data.action = action
-        current_frame = context.scene.frame_current
-        ret += ["%s%i," % (g_indent, toExport8F8(float(current_frame) / 24.0))]
-        # Iterate using armature order.
-        for jj in amap:
-            bone_orig = arm.data.bones[jj]
-            bone_curr = arm.pose.bones[jj]
-            # Heaven knows why we have to rearrange the quaternion order.
-            qq = toExportBoneQuaternion(bone_orig, bone_curr)
-            qw = toExport4F12(qq[0])
-            qx = toExport4F12(qq[1])
-            qy = toExport4F12(qq[2])
-            qz = toExport4F12(qq[3])
-            # The difference to original position is baked into the animation position.
-            hd = toExportBonePosition(mat, qq, bone_orig, bone_curr)
-            px = toExportS16(hd[0] * armature_scale[0] * export_scale)
-            py = toExportS16(hd[1] * armature_scale[1] * export_scale)
-            pz = toExportS16(hd[2] * armature_scale[2] * export_scale)
-            ret += ["%s%i, %i, %i, %i, %i, %i, %i," % (g_indent, px, py, pz, qw, qx, qy, qz)]
-        # Advance to next frame, abort if not possible.
-        if bpy.ops.screen.keyframe_jump(next=True) != {"FINISHED"}:
-            break
-        bpy.ops.wm.redraw_timer(type="DRAW_WIN_SWAP", iterations=1)
+    bones_curr = []
+    heads_curr = []
+    for current_frame in frames:
+        # Setting the frame evaluates the dependency graph, no viewport redraw is needed for the pose to update.
+        context.scene.frame_set(current_frame)
+        bones_curr.append(getBoneMatrices(arm.pose.bones, "matrix")[pose_order])
+        heads_curr.append(getBoneVectors(arm.pose.bones, "head")[pose_order])
+    context.scene.frame_set(original_frame)
+    # Convert bones of all frames at once.
+    frame_count = len(frames)
+    bones_curr = np.array(bones_curr).reshape(-1, 4, 4)
+    heads_curr = np.array(heads_curr).reshape(-1, 3)
+    # Heaven knows why we have to rearrange the quaternion order.
+    qq = toExportBoneQuaternions(np.tile(world, (frame_count, 1, 1)), bones_curr)
+    # The difference to original position is baked into the animation position.
+    hd = toExportBonePositions(mat, qq, np.tile(pos_orig, (frame_count, 1)), heads_curr)
+    return (frames, qq, hd)
+
+def animFindMaxPositionValue(positions, armature_scale):
+    """Finds greatest bone position value in rest and animated bone positions."""
+    scale = np.array(armature_scale)
+    return max([float(np.abs(ii * scale).max(initial=0.0)) for ii in positions])
+
+def getBoneExportScale(export_scale, max_bone_value):
+    """Get separate bone export scale and its ratio to mesh export scale."""
+    bone_export_scale = export_scale
+    if max_bone_value > 0.0:
+        bone_export_scale = 32767.0 / max_bone_value
+    return (bone_export_scale, export_scale / bone_export_scale)
+
+def animToString(anim, amap, action, model_name, armature_scale, export_scale):
+    """Exports singular animation to string."""
+    (frames, qq, hd) = anim
+    # One line for timestamp and one line per bone for every frame.
+    fmt = "\n".join(["%s%%i," % (g_indent)] + ["%s%%i, %%i, %%i, %%i, %%i, %%i, %%i," % (g_indent)] * len(amap))
+    ret = ""
+    frame_count = len(frames)
+    if frame_count:
+        qd = toExport4F12Array(qq)
+        pd = toExportS16Array(hd * np.array(armature_scale) * export_scale)
+        times = toExport8F8Array(np.array(frames, dtype=np.float64) / 24.0)
+        data = np.hstack((times.reshape(-1, 1), np.hstack((pd, qd)).reshape(frame_count, -1)))
+        ret = "\n".join([fmt] * frame_count) % tuple(data.ravel().tolist())
     # Create export string.
     anim_name = toExportName(action.name)
     subst = {
-            "ANIM_DATA" : "\n".join(ret),
+            "ANIM_DATA" : ret,
             "MODEL_NAME" : model_name,
             "ANIM_NAME" : anim_name,
             }
     return g_template_anim.format(subst)
 
-def exportAllMeshesToHeader(filename, context):
+def exportAllMeshesToHeader(filename, context, bone_scale=False):
     export_strings = []
     # Find mesh.
     msh = findMesh(context)
@@ -430,34 +574,50 @@ def exportAllMeshesToHeader(filename, context):
     vgl_log("selected mesh for export: '%s' => '%s'" % (msh.name, export_name))
     # Evaluate dependency graph for the mesh, it probably has some decimate or something.
     msh = msh.evaluated_get(context.evaluated_depsgraph_get())
+    # Read vertex coordinates only once, they are needed for both export scale and vertex data.
+    co = meshGetVertexCoordinates(msh.data, msh.scale)
     # Everything needs to be exported in the same scale, discard three bits of accuracy and fit in int16_t.
-    export_scale = 32767.0 / (meshFindMaxVertexValue(msh.data, msh.scale) * 8.0)
+    export_scale = 32767.0 / (meshFindMaxVertexValue(co) * 8.0)
     # Find armatures.
     arm = findArmature(context)
+    amap = None
+    vmap = None
+    if arm:
+        amap = getArmatureOrdering(arm.data)
+        vmap = getVertexGroupOrdering(msh, amap)
+    # Export mesh before animations change the current frame, all mesh passes read the same evaluated state.
+    mesh_string = meshToString(context, msh.data, co, vmap, export_name, export_scale)
     # Export armature.
     if arm:
         # Not having scale 1 is suspicious.
         if (msh.scale != arm.scale) or (msh.scale != Vector((1.0, 1.0, 1.0))) or (arm.scale != Vector((1.0, 1.0, 1.0))):
             vgl_log("WARNING: suspicious mesh/armature scales: %s ; %s" % (str(msh.scale), str(arm.scale)))
         vgl_log("selected armature for export: '%s'" % (arm.name))
-        amap = getArmatureOrdering(arm.data)
         vgl_log("bone mapping: %s" % (str(amap)))
-        export_strings += [armatureToString(arm.data, export_name, arm.matrix_basis, arm.scale, export_scale)]
-        # Animations in armatures.
-        for ii in bpy.data.actions:
-            export_strings += [animToString(context, amap, arm, ii, export_name, arm.matrix_basis, arm.scale, export_scale)]
-    # Export mesh.
-    vmap = None
-    if arm:
-        vmap = getVertexGroupOrdering(msh, amap)
         vgl_log("vertex mapping: %s" % (str(vmap)))
-    export_strings += [meshToString(context, msh.data, vmap, export_name, msh.scale, export_scale)]
-    with open(filename, "w") as fd:
+        # Evaluate all animations before converting them, separate bone scale depends on every animated position.
+        rest = getArmatureRestData(arm, arm.matrix_basis)
+        anims = [(ii, animGetFrames(context, amap, arm, rest, ii, arm.matrix_basis)) for ii in bpy.data.actions]
+        bone_export_scale = export_scale
+        if bone_scale:
+            # Bone positions use the full int16_t range of their own.
+            # The exported scale is relative to mesh units, multiply the scale used for the mesh with it.
+            max_bone_value = animFindMaxPositionValue([rest[1]] + [vv[2] for (ii, vv) in anims], arm.scale)
+            (bone_export_scale, bone_scale_ratio) = getBoneExportScale(export_scale, max_bone_value)
+            export_strings.append(g_template_bone_scale.format({"MODEL_NAME" : export_name,
+                "BONE_SCALE" : "%.9ef" % (bone_scale_ratio)}))
+        export_strings.append(armatureToString(arm.data, export_name, arm.matrix_basis, arm.scale, bone_export_scale))
+        # Animations in armatures.
+        for (ii, vv) in anims:
+            export_strings.append(animToString(vv, amap, ii, export_name, arm.scale, bone_export_scale))
+    export_strings.append(mesh_string)
+    # Write in binary mode with a large buffer, header data is plain text anyway.
+    with open(filename, "wb", buffering=g_write_buffer_size) as fd:
         subst = {
                 "MODEL_DATA" : "\n\n".join(export_strings),
                 "HEADER_NAME" : "__" + os.path.basename(filename).replace(".", "_").lower() + "__",
                 }
-        fd.write(g_template_header.format(subst))
+        g_template_header.write(fd, subst)
 
 ########################################
 # Blender export operator ##############
@@ -475,9 +635,11 @@ class VglOperatorExport(Operator, ExportHelper):
 
     filter_glob: StringProperty(default="*.hpp", options={'HIDDEN'})
 
+    bone_scale: BoolProperty(name="Separate bone scale", description="Quantize bone positions with their own scale, exported as g_bone_scale_<model>: multiply the mesh scale with it when loading the armature and animations", default=False)
+
     def execute(self, context):
         filu = self.filepath
-        exportAllMeshesToHeader(filu, context)
+        exportAllMeshesToHeader(filu, context, self.bone_scale)
         return {"FINISHED"}
 
 def vgl_menu_export(self, context):
@@ -0,0 +1,91 @@
+"""Tests for the Blender 2.90 exporter, scene tests need Blender's Python or the bpy module."""
+
+import ast
+import os
+import re
+import types
+
+import numpy as np
+import pytest
+
+g_exporter_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "io_export_vgl_2_90.py")
+
+def loadExporterFunctions(*names):
+    """Loads given NumPy-only functions from the exporter source without importing bpy."""
+    with open(g_exporter_filename) as fd:
+        tree = ast.parse(fd.read(), g_exporter_filename)
+    functions = [ii for ii in tree.body if isinstance(ii, ast.FunctionDef) and ii.name in names]
+    assert len(functions) == len(names)
+    ret = {"np" : np}
+    exec(compile(ast.Module(body=functions, type_ignores=[]), g_exporter_filename, "exec"), ret)
+    return types.SimpleNamespace(**{ii : ret[ii] for ii in names})
+
+def readExportedArray(content, name):
+    """Reads an exported integer array from header content."""
+    match = re.search(r"%s\[\] =\n\{\n(.*?)\n\};" % (re.escape(name)), content, re.S)
+    assert match, "array '%s' not found" % (name)
+    return np.array([[int(jj) for jj in ii.strip().rstrip(",").split(",")] for ii in match.group(1).splitlines()])
+
+def test_bone_scale_ratio_matches_mesh_space():
+    """Bone positions quantized with the bone scale must land in mesh space when multiplied with the ratio."""
+    exporter = loadExporterFunctions("getBoneExportScale", "toExportS16Array")
+    positions = np.array([[0.5, -0.25, 0.125], [-0.75, 0.0, 0.375], [0.0, 0.0, 0.0]])
+    # Mesh scale leaves headroom, bones span a smaller range of their own.
+    export_scale = 32767.0 / (4.0 * 8.0)
+    (bone_export_scale, ratio) = exporter.getBoneExportScale(export_scale, 0.75)
+    assert bone_export_scale == 32767.0 / 0.75
+    assert ratio == export_scale / bone_export_scale
+    vertices = exporter.toExportS16Array(positions * export_scale)
+    bones = exporter.toExportS16Array(positions * bone_export_scale)
+    assert np.abs(bones).max() == 32767
+    # Both values are rounded to integers, allow one step of quantization error.
+    assert np.all(np.abs(bones * ratio - vertices) <= 1.0)
+
+def test_bone_scale_ratio_without_bone_positions():
+    """Bones all at origin fall back to mesh export scale."""
+    exporter = loadExporterFunctions("getBoneExportScale")
+    assert exporter.getBoneExportScale(1024.0, 0.0) == (1024.0, 1.0)
+
+def createScene(bpy):
+    """Creates a mesh with a vertex at the head of the only bone of an armature."""
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    scene = bpy.context.scene
+    arm_data = bpy.data.armatures.new("g_testarm")
+    arm = bpy.data.objects.new("g_testarm", arm_data)
+    scene.collection.objects.link(arm)
+    bpy.context.view_layer.objects.active = arm
+    bpy.ops.object.mode_set(mode="EDIT")
+    bone = arm_data.edit_bones.new("root")
+    bone.head = (0.5, -0.25, 0.125)
+    bone.tail = (0.5, -0.25, 1.0)
+    bpy.ops.object.mode_set(mode="OBJECT")
+    msh_data = bpy.data.meshes.new("g_testmesh")
+    msh_data.from_pydata([(0.5, -0.25, 0.125), (4.0, 0.0, 0.0), (0.0, 4.0, 0.0)], [], [(0, 1, 2)])
+    msh = bpy.data.objects.new("g_testmesh", msh_data)
+    # The exporter picks the mesh linked more than once as the original.
+    scene.collection.objects.link(msh)
+    collection = bpy.data.collections.new("instances")
+    scene.collection.children.link(collection)
+    collection.objects.link(msh)
+    msh.vertex_groups.new(name="root").add([0, 1, 2], 1.0, "REPLACE")
+    return types.SimpleNamespace(selectable_objects=list(scene.objects), scene=scene,
+            evaluated_depsgraph_get=bpy.context.evaluated_depsgraph_get)
+
+def test_bone_scale_matches_mesh_space(tmp_path):
+    """Bone positions multiplied with the exported bone scale must land in mesh vertex space."""
+    bpy = pytest.importorskip("bpy")
+    import io_export_vgl_2_90
+    context = createScene(bpy)
+    filename = str(tmp_path / "model.hpp")
+    io_export_vgl_2_90.exportAllMeshesToHeader(filename, context, bone_scale=True)
+    with open(filename) as fd:
+        content = fd.read()
+    match = re.search(r"const float g_bone_scale_g_testmesh = (\S+)f;", content)
+    assert match
+    bone_scale = float(match.group(1))
+    vertices = readExportedArray(content, "g_vertices_g_testmesh")
+    bones = readExportedArray(content, "g_bones_g_testmesh")
+    # Separate bone scale only makes sense if it gains precision.
+    assert bone_scale < 1.0
+    # Both values are rounded to integers, allow one step of quantization error.
+    assert np.all(np.abs(bones[0] * bone_scale - vertices[0]) <= 1.0)
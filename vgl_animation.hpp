@@ -31,11 +31,12 @@ public:
     /// \param animation_amount Amount of animation elements.
     /// \param scale Model scale.
     /// \param hierarchical Is the animation hierarchical?
+    /// \param packed Are rotations packed into 10-10-10-2 format?
     explicit Animation(const int16_t *data, unsigned bone_amount, unsigned animation_amount, float scale,
-            bool hierarchical = false) :
+            bool hierarchical = false, bool packed = false) :
         m_hierarchical(hierarchical)
     {
-        readRaw(data, bone_amount, animation_amount, scale);
+        readRaw(data, bone_amount, animation_amount, scale, packed);
     }
 
 private:
@@ -44,9 +45,10 @@ private:
     /// \param data Animation data.
     /// \param bone_amount Amount of bone elements.
     /// \param animation_amount Amount of animation elements.
-    void readRaw(const int16_t *data, unsigned bone_amount, unsigned animation_amount, float scale)
+    /// \param packed Are rotations packed into 10-10-10-2 format?
+    void readRaw(const int16_t *data, unsigned bone_amount, unsigned animation_amount, float scale, bool packed)
     {
-        unsigned frame_amount = bone_amount / 3 * 7;
+        unsigned frame_amount = bone_amount / 3 * (packed ? 5 : 7);
 
 #if defined(USE_LD)
         if(animation_amount % (frame_amount + 1) != 0)
@@ -59,7 +61,7 @@ private:
 
         for(unsigned ii = 0; (ii < animation_amount); ii += frame_amount + 1)
         {
-            m_frames.emplace_back(data + ii, frame_amount, scale);
+            m_frames.emplace_back(data + ii, frame_amount, scale, packed);
         }
     }
 
@@ -118,10 +120,11 @@ public:
     /// \param animation_amount Amount of animation elements.
     /// \param scale Scale to multiply with.
     /// \param hierarchical Is the animation hierarchical?
+    /// \param packed Are rotations packed into 10-10-10-2 format?
     static unique_ptr<Animation> create(const int16_t *data, unsigned bone_amount, unsigned animation_amount, float scale,
-            bool hierarchical = false)
+            bool hierarchical = false, bool packed = false)
     {
-        return unique_ptr<Animation>(new Animation(data, bone_amount, animation_amount, scale, hierarchical));
+        return unique_ptr<Animation>(new Animation(data, bone_amount, animation_amount, scale, hierarchical, packed));
     }
 
 public:
@@ -7,6 +7,40 @@
 namespace vgl
 {
 
+namespace detail
+{
+
+/// Convert 10-10-10-2 packed rotation into a quaternion.
+///
+/// The packed 32-bit value is stored as two 16-bit halves, lower half first. The 2-bit field stores the index of
+/// the largest component in (w, x, y, z) order, the three 10-bit signed values store the remaining components in
+/// order, scaled by sqrt(2). The largest component is positive and reconstructed from quaternion unit length.
+///
+/// \param op Packed input data.
+/// \return Unpacked quaternion.
+inline quat packed_10_10_10_2_to_quat(const int16_t *op)
+{
+    uint32_t packed = static_cast<uint32_t>(static_cast<uint16_t>(op[0])) |
+        (static_cast<uint32_t>(static_cast<uint16_t>(op[1])) << 16);
+    float aa = static_cast<float>(static_cast<int32_t>(packed << 22) >> 22) * (1.0f / (511.0f * 1.41421356f));
+    float bb = static_cast<float>(static_cast<int32_t>(packed << 12) >> 22) * (1.0f / (511.0f * 1.41421356f));
+    float cc = static_cast<float>(static_cast<int32_t>(packed << 2) >> 22) * (1.0f / (511.0f * 1.41421356f));
+    float dd = sqrt(max(1.0f - aa * aa - bb * bb - cc * cc, 0.0f));
+    switch(packed >> 30)
+    {
+    case 0:
+        return quat(dd, aa, bb, cc);
+    case 1:
+        return quat(aa, dd, bb, cc);
+    case 2:
+        return quat(aa, bb, dd, cc);
+    default:
+        return quat(aa, bb, cc, dd);
+    }
+}
+
+}
+
 /// Animation frame.
 class AnimationFrame
 {
@@ -26,9 +60,10 @@ public:
     /// \param data Frame data.
     /// \param bone_amount Amount of bone elements.
     /// \param scale Model scale.
-    explicit AnimationFrame(const int16_t *data, unsigned bone_amount, float scale)
+    /// \param packed Are rotations packed into 10-10-10-2 format?
+    explicit AnimationFrame(const int16_t *data, unsigned bone_amount, float scale, bool packed = false)
     {
-        readRaw(data, bone_amount, scale);
+        readRaw(data, bone_amount, scale, packed);
     }
 
 private:
@@ -37,12 +72,15 @@ private:
     /// \param data Frame data.
     /// \param bone_amount Amount of bone elements.
     /// \param scale Model scale.
-    void readRaw(const int16_t *data, unsigned frame_amount, float scale)
+    /// \param packed Are rotations packed into 10-10-10-2 format?
+    void readRaw(const int16_t *data, unsigned frame_amount, float scale, bool packed)
     {
+        unsigned bone_stride = packed ? 5 : 7;
+
         m_time = fixed_8_8_to_float(data[0]);
 
 #if defined(USE_LD)
-        if((frame_amount % 7) != 0)
+        if((frame_amount % bone_stride) != 0)
         {
             std::ostringstream sstr;
             sstr << "invalid frame amount: " << frame_amount;
@@ -50,11 +88,16 @@ private:
         }
 #endif
 
-        for(unsigned ii = 1; ((frame_amount + 1) > ii); ii += 7)
+        for(unsigned ii = 1; ((frame_amount + 1) > ii); ii += bone_stride)
         {
             vec3 pos(static_cast<float>(data[ii + 0]) * scale,
                     static_cast<float>(data[ii + 1]) * scale,
                     static_cast<float>(data[ii + 2]) * scale);
+            if(packed)
+            {
+                m_bones.emplace_back(pos, detail::packed_10_10_10_2_to_quat(data + ii + 3));
+                continue;
+            }
             quat rot(fixed_4_12_to_float(data[ii + 3]),
                     fixed_4_12_to_float(data[ii + 4]),
                     fixed_4_12_to_float(data[ii + 5]),
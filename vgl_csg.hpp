@@ -778,20 +778,26 @@ void csg_read_data(LogicalMesh& msh, const int16_t* data)
     }
 }
 
-/// Add raw model data.
+/// Add raw model data with quantized vertices.
 ///
 /// Bone input is arranged as 3 weights and 3 references.
 /// The 3 weights should add up to 255.
 ///
+/// If offset and step are given, vertex position is offset + vertex * step before scaling.
+/// Vertex type may be any of int8_t, uint8_t, int16_t or uint16_t.
+///
 /// \param vertices Vertex input.
+/// \param offset Per-axis vertex offset (may be null).
+/// \param step Per-axis vertex quantization step (may be null).
 /// \param bones Bone input.
 /// \param faces Face input.
 /// \param vertices_amount Vertex data element count.
 /// \param bones_amount Bone data element count.
 /// \param faces_amount Face data element count.
 /// \param scale Scale to multiply with.
-void csg_read_raw(LogicalMesh& msh, const int16_t *vertices, const uint8_t *bones, const uint16_t* faces,
-        unsigned vertices_amount, unsigned bones_amount, unsigned faces_amount, float scale)
+template<typename T> void csg_read_raw(LogicalMesh& msh, const T *vertices, const float *offset,
+        const float *step, const uint8_t *bones, const uint16_t* faces, unsigned vertices_amount,
+        unsigned bones_amount, unsigned faces_amount, float scale)
     {
 #if defined(USE_LD)
         if(bones && ((vertices_amount * 2) != bones_amount))
@@ -809,9 +815,16 @@ void csg_read_raw(LogicalMesh& msh, const int16_t *vertices, const uint8_t *bone
 
         for(unsigned ii = 0, jj = 0; (ii < vertices_amount); ii += 3, jj += 6)
         {
-            vec3 ver(static_cast<float>(vertices[ii + 0]) * scale,
-                    static_cast<float>(vertices[ii + 1]) * scale,
-                    static_cast<float>(vertices[ii + 2]) * scale);
+            vec3 ver(static_cast<float>(vertices[ii + 0]),
+                    static_cast<float>(vertices[ii + 1]),
+                    static_cast<float>(vertices[ii + 2]));
+            if(offset && step)
+            {
+                ver = vec3(offset[0] + ver.x() * step[0],
+                        offset[1] + ver.y() * step[1],
+                        offset[2] + ver.z() * step[2]);
+            }
+            ver *= scale;
 
             if(bones)
             {
@@ -841,6 +854,24 @@ void csg_read_raw(LogicalMesh& msh, const int16_t *vertices, const uint8_t *bone
     }
     /// Add raw model data.
     ///
+    /// Bone input is arranged as 3 weights and 3 references.
+    /// The 3 weights should add up to 255.
+    ///
+    /// \param vertices Vertex input.
+    /// \param bones Bone input.
+    /// \param faces Face input.
+    /// \param vertices_amount Vertex data element count.
+    /// \param bones_amount Bone data element count.
+    /// \param faces_amount Face data element count.
+    /// \param scale Scale to multiply with.
+    void csg_read_raw(LogicalMesh& msh, const int16_t *vertices, const uint8_t *bones, const uint16_t* faces,
+            unsigned vertices_amount, unsigned bones_amount, unsigned faces_amount, float scale)
+    {
+        csg_read_raw<int16_t>(msh, vertices, nullptr, nullptr, bones, faces, vertices_amount, bones_amount,
+                faces_amount, scale);
+    }
+    /// Add raw model data.
+    ///
     /// Bone data is not added.
     ///
     /// \param vertices Vertex input.
@@ -19,6 +19,8 @@ namespace detail
 void csg_read_data(LogicalMesh&, const int16_t*);
 void csg_read_raw(LogicalMesh&, const int16_t*, const uint8_t*, const uint16_t*, unsigned, unsigned, unsigned, float);
 void csg_read_raw(LogicalMesh&, const int16_t*, const uint16_t*, unsigned, unsigned, float);
+template<typename T> void csg_read_raw(LogicalMesh&, const T*, const float*, const float*, const uint8_t*,
+        const uint16_t*, unsigned, unsigned, unsigned, float);
 /// \endcond
 
 #if defined(USE_LD)
@@ -84,6 +86,26 @@ public:
     {
         detail::csg_read_raw(*this, vertices, nullptr, faces, vertices_amount, 0, faces_amount, scale);
     }
+    /// Constructor using raw data with quantized vertices.
+    ///
+    /// Vertex position is offset + vertex * step before scaling.
+    ///
+    /// \param vertices Vertex input (int8_t, uint8_t, int16_t or uint16_t).
+    /// \param offset Per-axis vertex offset.
+    /// \param step Per-axis vertex quantization step.
+    /// \param bones Bone input (may be null).
+    /// \param faces Face input.
+    /// \param vertices_amount Vertex data element count.
+    /// \param bones_amount Bone data element count.
+    /// \param faces_amount Face data element count.
+    /// \param scale Scale to multiply with.
+    template<typename T> explicit LogicalMesh(const T *vertices, const float *offset, const float *step,
+            const uint8_t *bones, const uint16_t* faces, unsigned vertices_amount, unsigned bones_amount,
+            unsigned faces_amount, float scale)
+    {
+        detail::csg_read_raw(*this, vertices, offset, step, bones, faces, vertices_amount, bones_amount, faces_amount,
+                scale);
+    }
 
 private:
     /// Add face (internal).